@@ -1,9 +1,24 @@
 import os
+
+# OpenCV and NumPy work runs on Python level workers (resize threads, tf.data map calls), keep the
+# OpenMP/MKL pools single-threaded so they don't oversubscribe cores; must be set before importing numpy
+os.environ.setdefault('OMP_NUM_THREADS', '1')
+os.environ.setdefault('MKL_NUM_THREADS', '1')
+
+import copy
+import json
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import keras
 import numpy as np
+import tensorflow as tf
 import matplotlib.pyplot as plt
 import segmentation_models as sm
+from numba import njit
+
+cv2.setNumThreads(1)
 
 # Loading dataset
 if not os.path.exists('./dataset/'):
@@ -26,15 +41,122 @@ min_size = 480
 assert width >= min_size
 assert height >= min_size
 
-for dir_path in directories.values():
+# one reusable destination buffer per worker thread
+resize_buffers = threading.local()
+
+
+def resize_one(item):
+    path, (write_path, interpolation) = item
+    img = cv2.imread(path)
+    if not hasattr(resize_buffers, 'dst'):
+        resize_buffers.dst = np.empty((height, width, 3), dtype=np.uint8)
+    resized = cv2.resize(img, (width, height), dst=resize_buffers.dst, interpolation=interpolation)
+    os.remove(path)
+    cv2.imwrite(write_path, resized)
+
+
+# several directory entries point to the same folder, resize each folder once
+# and mark it with the target size so reruns skip it until the size changes
+RESIZED_MARKER = '.resized'
+resized_size = f'{width}x{height}'
+
+
+def is_resized(dir_path):
+    marker_path = os.path.join(dir_path, RESIZED_MARKER)
+    if not os.path.exists(marker_path):
+        return False
+    with open(marker_path) as f:
+        return f.read() == resized_size
+
+
+resize_dirs = [d for d in sorted(set(directories.values())) if not is_resized(d)]
+
+# area interpolation for images, nearest for color coded masks so no off-palette colors are mixed in
+interpolations = {dir_path: cv2.INTER_NEAREST if key.startswith('y_') else cv2.INTER_AREA
+                  for key, dir_path in directories.items()}
+
+pairs = {}
+for dir_path in resize_dirs:
     for subdir, _, files in os.walk(dir_path):
         for file in files:
+            if file.startswith('.'):
+                continue
             path = os.path.join(subdir, file)
-            img = cv2.imread(path)
-            resized = cv2.resize(img, (width, height))
-            os.remove(path)
-            write_path = os.path.splitext(path)[0] + '.png'
-            cv2.imwrite(write_path, resized)
+            pairs[path] = (os.path.splitext(path)[0] + '.png', interpolations[dir_path])
+
+# OpenCV releases the GIL while decoding, resizing and encoding, so threads scale well here
+with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+    list(executor.map(resize_one, pairs.items()))
+
+for dir_path in resize_dirs:
+    with open(os.path.join(dir_path, RESIZED_MARKER), 'w') as f:
+        f.write(resized_size)
+
+# Sample decoding kernels
+@njit(nogil=True, cache=True)
+def encode_mask(mask, lut, out):
+    """Write palette index of each pixel of color coded mask into buffer in a single pass."""
+    for y in range(mask.shape[0]):
+        for x in range(mask.shape[1]):
+            out[y, x] = lut[(int(mask[y, x, 0]) << 16) | (int(mask[y, x, 1]) << 8) | int(mask[y, x, 2])]
+
+
+@njit(nogil=True, cache=True)
+def normalize_image(image, scale, bias, out):
+    """Write per channel scaled and shifted uint8 image into float buffer in a single pass."""
+    for y in range(image.shape[0]):
+        for x in range(image.shape[1]):
+            for c in range(image.shape[2]):
+                out[y, x, c] = image[y, x, c] * scale[c] + bias[c]
+
+
+# compile once up front instead of on the first sample
+encode_mask(np.zeros((1, 1, 3), dtype=np.uint8), np.zeros(1, dtype=np.uint8), np.zeros((1, 1), dtype=np.uint8))
+normalize_image(np.zeros((1, 1, 3), dtype=np.uint8), np.ones(3, dtype=np.float32), np.zeros(3, dtype=np.float32),
+                np.zeros((1, 1, 3), dtype=np.float32))
+
+# Decoded dataset cache
+CACHE_DIR = './dataset/Cache'
+
+
+def build_cache(images_dir, masks_dir, cache_dir, palette):
+    """Decode resized images and masks once into raw memmap files reused across epochs.
+
+    Masks are stored as the index of each pixel color in palette, colors outside of it get len(palette).
+    """
+    ids = sorted(f for f in os.listdir(images_dir) if not f.startswith('.'))
+    shape = (len(ids), height, width, 3)
+
+    # reuse the cache only if it was built from the same files, size and palette
+    shapes_path = os.path.join(cache_dir, 'shapes.json')
+    if os.path.exists(shapes_path):
+        with open(shapes_path) as f:
+            meta = json.load(f)
+        if meta.get('ids') == ids and meta.get('shape') == list(shape) and meta.get('palette') == palette:
+            return
+
+    # lookup table from packed 24-bit mask color to palette index
+    lut = np.full(256 ** 3, len(palette), dtype=np.uint8)
+    for k, (c0, c1, c2) in enumerate(palette):
+        lut[(c0 << 16) | (c1 << 8) | c2] = k
+
+    os.makedirs(cache_dir, exist_ok=True)
+    images = np.memmap(os.path.join(cache_dir, 'images.dat'), dtype=np.uint8, mode='w+', shape=shape)
+    masks = np.memmap(os.path.join(cache_dir, 'masks.dat'), dtype=np.uint8, mode='w+', shape=shape[:3])
+
+    def cache_one(k):
+        # reversed channel view turns BGR into RGB while copying into the cache
+        images[k] = cv2.imread(os.path.join(images_dir, ids[k]))[..., ::-1]
+        encode_mask(cv2.imread(os.path.join(masks_dir, ids[k])), lut, np.asarray(masks[k]))
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(cache_one, range(len(ids))))
+    images.flush()
+    masks.flush()
+
+    # written last so an interrupted run rebuilds the cache
+    with open(shapes_path, 'w') as f:
+        json.dump({'ids': ids, 'shape': shape, 'palette': palette}, f)
 
 
 # Utility function for data visualization
@@ -49,10 +171,10 @@ def visualize_and_denormalize(**images):
         plt.title(' '.join(name.split('_')).title())
 
         # Denormalize image
-        x_max = np.percentile(image, 98)
-        x_min = np.percentile(image, 2)
-        image = (image - x_min) / (x_max - x_min)
-        image = image.clip(0, 1)
+        x_min, x_max = np.percentile(image, (2, 98))
+        image = image - x_min
+        np.multiply(image, 1.0 / (x_max - x_min), out=image)
+        np.clip(image, 0, 1, out=image)
 
         plt.imshow(image)
     plt.show()
@@ -69,6 +191,8 @@ class Dataset:
             (e.g. flip, scale, etc.)
         preprocessing (albumentations.Compose): data preprocessing
             (e.g. noralization, shape manipulation, etc.)
+        normalization (tuple): per channel mean and std of images scaled to [0, 1],
+            applied after augmentation and preprocessing
 
     """
 
@@ -83,27 +207,42 @@ class Dataset:
             classes=None,
             augmentation=None,
             preprocessing=None,
+            normalization=None,
     ):
-        self.ids = os.listdir(images_dir)
-        self.images_fps = [os.path.join(images_dir, image_id) for image_id in self.ids]
-        self.masks_fps = [os.path.join(masks_dir, image_id) for image_id in self.ids]
-
-        # convert str names to class values on masks
-        self.class_colors = [self.CLASSES.get(key) for key in classes]
+        cache_dir = os.path.join(CACHE_DIR, os.path.basename(os.path.normpath(images_dir)))
+        build_cache(images_dir, masks_dir, cache_dir, [color.tolist() for color in self.CLASSES.values()])
+        with open(os.path.join(cache_dir, 'shapes.json')) as f:
+            meta = json.load(f)
+
+        self.ids = meta['ids']
+        shape = tuple(meta['shape'])
+        self.images = np.memmap(os.path.join(cache_dir, 'images.dat'), dtype=np.uint8, mode='r', shape=shape)
+        self.masks = np.memmap(os.path.join(cache_dir, 'masks.dat'), dtype=np.uint8, mode='r', shape=shape[:3])
+
+        # one-hot row of selected classes for each palette index, the last row is for unknown colors
+        palette_names = list(self.CLASSES)
+        self.onehot = np.zeros((len(palette_names) + 1, len(classes)), dtype=np.uint8)
+        for k, key in enumerate(classes):
+            self.onehot[palette_names.index(key), k] = 1
 
         self.augmentation = augmentation
         self.preprocessing = preprocessing
 
+        # fold scaling to [0, 1] and standardization into a single multiply-add per channel
+        self.normalization = normalization
+        if normalization is not None:
+            mean, std = (np.asarray(v, dtype=np.float32) for v in normalization)
+            self.scale = 1 / (255 * std)
+            self.bias = -mean / std
+
     def __getitem__(self, i):
 
         # read data
-        image = cv2.imread(self.images_fps[i])
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        mask = cv2.imread(self.masks_fps[i])
+        image = self.images[i]
+        mask = self.masks[i]
 
         # extract certain classes from mask (e.g. cars)
-        masks = [(mask == c).all(axis=2) for c in self.class_colors]
-        mask = np.stack(masks, axis=-1).astype('float')
+        mask = self.onehot[mask]
 
         # apply augmentations
         if self.augmentation:
@@ -115,51 +254,52 @@ class Dataset:
             sample = self.preprocessing(image=image, mask=mask)
             image, mask = sample['image'], sample['mask']
 
+        # apply normalization
+        if self.normalization is not None:
+            normalized = np.empty(image.shape, dtype=np.float32)
+            normalize_image(image, self.scale, self.bias, normalized)
+            image = normalized
+
         return image, mask
 
     def __len__(self):
         return len(self.ids)
 
 
-class Dataloder(keras.utils.Sequence):
-    """Load data from dataset and form batches
+def make_tf_dataset(dataset, batch_size=1, shuffle=False):
+    """Build tf.data pipeline loading and augmenting samples on background threads
 
     Args:
         dataset: instance of Dataset class for image loading and preprocessing.
         batch_size: Integet number of images in batch.
         shuffle: Boolean, if `True` shuffle image indexes each epoch.
     """
-
-    def __init__(self, dataset, batch_size=1, shuffle=False):
-        self.dataset = dataset
-        self.batch_size = batch_size
-        self.shuffle = shuffle
-        self.indexes = np.arange(len(dataset))
-
-        self.on_epoch_end()
-
-    def __getitem__(self, i):
-
-        # collect batch data
-        start = i * self.batch_size
-        stop = (i + 1) * self.batch_size
-        data = []
-        for j in range(start, stop):
-            data.append(self.dataset[j])
-
-        # transpose list of lists
-        batch = [np.stack(samples, axis=0) for samples in zip(*data)]
-
-        return batch
-
-    def __len__(self):
-        """Denotes the number of batches per epoch"""
-        return len(self.indexes) // self.batch_size
-
-    def on_epoch_end(self):
-        """Callback function to shuffle indexes each epoch"""
-        if self.shuffle:
-            self.indexes = np.random.permutation(self.indexes)
+    image, mask = dataset[0]
+
+    # albumentations transforms keep per-call state on the instance, give each map thread its own pipelines
+    local = threading.local()
+
+    def load(i):
+        if not hasattr(local, 'dataset'):
+            local.dataset = copy.copy(dataset)
+            local.dataset.augmentation = copy.deepcopy(dataset.augmentation)
+            local.dataset.preprocessing = copy.deepcopy(dataset.preprocessing)
+        image, mask = local.dataset[i]
+        return image.astype(np.float32, copy=False), mask
+
+    def load_tf(i):
+        sample_image, sample_mask = tf.numpy_function(load, [i], (tf.float32, tf.uint8))
+        sample_image.set_shape(image.shape)
+        sample_mask.set_shape(mask.shape)
+        # masks stay uint8 through loading and augmentation, losses need them as float
+        return sample_image, tf.cast(sample_mask, tf.float32)
+
+    tf_dataset = tf.data.Dataset.range(len(dataset))
+    if shuffle:
+        tf_dataset = tf_dataset.shuffle(len(dataset), reshuffle_each_iteration=True)
+    tf_dataset = tf_dataset.map(load_tf, num_parallel_calls=tf.data.AUTOTUNE)
+    tf_dataset = tf_dataset.batch(batch_size, drop_remainder=True)
+    return tf_dataset.prefetch(tf.data.AUTOTUNE)
 
 # Lets look at data we have
 dataset = Dataset(x_train_dir, y_train_dir, classes=['nonmaskingbackground', 'maskingbackground', 'animal',
@@ -183,6 +323,7 @@ def round_clip_0_1(x, **kwargs):
     return x.round().clip(0, 1)
 
 # define heavy augmentations
+@functools.lru_cache(maxsize=None)
 def get_training_augmentation():
     train_transform = [
 
@@ -226,6 +367,7 @@ def get_training_augmentation():
     return A.Compose(train_transform)
 
 
+@functools.lru_cache(maxsize=None)
 def get_validation_augmentation(width, height):
     """Add paddings to make image shape divisible by 32"""
     if width % 32 != 0:
@@ -238,22 +380,6 @@ def get_validation_augmentation(width, height):
     ]
     return A.Compose(test_transform)
 
-def get_preprocessing(preprocessing_fn):
-    """Construct preprocessing transform
-
-    Args:
-        preprocessing_fn (callbale): data normalization function
-            (can be specific for each pretrained neural network)
-    Return:
-        transform: albumentations.Compose
-
-    """
-
-    _transform = [
-        A.Lambda(image=preprocessing_fn),
-    ]
-    return A.Compose(_transform)
-
 # Lets look at augmented data we have
 dataset = Dataset(x_train_dir, y_train_dir, classes=['nonmaskingbackground', 'maskingbackground', 'animal',
                'nonmaskingforegroundattention', 'unlabelled'], augmentation=get_training_augmentation())
@@ -275,17 +401,23 @@ CLASSES = ['animal']
 LR = 0.0001
 EPOCHS = 1
 
-preprocess_input = sm.get_preprocessing(BACKBONE)
+# efficientnet backbones expect 'torch' style input: RGB scaled to [0, 1], then standardized per channel
+normalization = ([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
 
 # define network parameters
 n_classes = 1 if len(CLASSES) == 1 else len(CLASSES)  # case for binary and multiclass segmentation
 activation = 'sigmoid' if n_classes == 1 else 'softmax'
 
-#create model
-model = sm.Unet(BACKBONE, classes=n_classes, activation=activation)
+# train in mixed precision, float16 compute with float32 master weights
+keras.mixed_precision.set_global_policy('mixed_float16')
+
+#create model, final activation is kept in float32 so losses and metrics are computed in full precision
+model = sm.Unet(BACKBONE, classes=n_classes, activation=None)
+output = keras.layers.Activation(activation, dtype='float32', name='output_' + activation)(model.output)
+model = keras.models.Model(model.input, output)
 
-# define optomizer
-optim = keras.optimizers.Adam(LR)
+# define optomizer, loss scaling prevents float16 gradients from underflowing
+optim = keras.mixed_precision.LossScaleOptimizer(keras.optimizers.Adam(LR))
 
 # Segmentation models losses can be combined together by '+' and scaled by integer or float factor
 dice_loss = sm.losses.DiceLoss()
@@ -306,7 +438,7 @@ train_dataset = Dataset(
     y_train_dir,
     classes=CLASSES,
     augmentation=get_training_augmentation(),
-    preprocessing=get_preprocessing(preprocess_input),
+    normalization=normalization,
 )
 
 # Dataset for validation images
@@ -315,15 +447,15 @@ valid_dataset = Dataset(
     y_valid_dir,
     classes=CLASSES,
     augmentation=get_validation_augmentation(width, height),
-    preprocessing=get_preprocessing(preprocess_input),
+    normalization=normalization,
 )
 
-train_dataloader = Dataloder(train_dataset, batch_size=BATCH_SIZE, shuffle=True)
-valid_dataloader = Dataloder(valid_dataset, batch_size=1, shuffle=False)
+train_tf_dataset = make_tf_dataset(train_dataset, batch_size=BATCH_SIZE, shuffle=True)
+valid_tf_dataset = make_tf_dataset(valid_dataset, batch_size=1, shuffle=False)
 
 # check shapes for errors
-assert train_dataloader[0][0].shape == (BATCH_SIZE, min_size, min_size, 3)
-assert train_dataloader[0][1].shape == (BATCH_SIZE, min_size, min_size, n_classes)
+assert train_tf_dataset.element_spec[0].shape == (BATCH_SIZE, min_size, min_size, 3)
+assert train_tf_dataset.element_spec[1].shape == (BATCH_SIZE, min_size, min_size, n_classes)
 
 
 # define callbacks for learning rate scheduling and best checkpoints saving
@@ -333,13 +465,11 @@ callbacks = [
 ]
 
 # train model
-history = model.fit_generator(
-    train_dataloader,
-    steps_per_epoch=len(train_dataloader),
+history = model.fit(
+    train_tf_dataset,
     epochs=EPOCHS,
     callbacks=callbacks,
-    validation_data=valid_dataloader,
-    validation_steps=len(valid_dataloader),
+    validation_data=valid_tf_dataset,
 )
 
 # Plot training & validation iou_score values
@@ -369,15 +499,15 @@ test_dataset = Dataset(
     y_test_dir,
     classes=CLASSES,
     augmentation=get_validation_augmentation(width, height),
-    preprocessing=get_preprocessing(preprocess_input),
+    normalization=normalization,
 )
 
-test_dataloader = Dataloder(test_dataset, batch_size=1, shuffle=False)
+test_tf_dataset = make_tf_dataset(test_dataset, batch_size=1, shuffle=False)
 
 # load best weights
 model.load_weights('best_model.h5')
 
-scores = model.evaluate_generator(test_dataloader)
+scores = model.evaluate(test_tf_dataset)
 
 print("Loss: {:.5}".format(scores[0]))
 for metric, value in zip(metrics, scores[1:]):
@@ -388,11 +518,12 @@ for metric, value in zip(metrics, scores[1:]):
 n = 5
 ids = np.random.choice(np.arange(len(test_dataset)), size=n)
 
-for i in ids:
+# predict all samples in a single call
+samples = [test_dataset[i] for i in ids]
+images = np.stack([image for image, _ in samples], axis=0)
+pr_masks = model.predict(images, batch_size=n).round()
 
-    image, gt_mask = test_dataset[i]
-    image = np.expand_dims(image, axis=0)
-    pr_mask = model.predict(image).round()
+for image, (_, gt_mask), pr_mask in zip(images, samples, pr_masks):
 
     visualize(
         image=denormalize(image.squeeze()),